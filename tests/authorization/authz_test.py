@@ -20,7 +20,7 @@
 #
 import admin_server
 import argparse
-import authlib
+import collections
 import fdb
 import os
 import pytest
@@ -29,18 +29,20 @@ import sys
 import time
 from multiprocessing import Process, Pipe
 from typing import Union
-from util import alg_from_kty, public_keyset_from_keys, random_alphanum_str, random_alphanum_bytes, to_str, to_bytes, KeyFileReverter, token_claim_1h, wait_until_tenant_tr_succeeds, wait_until_tenant_tr_fails
+from util import alg_from_kty, public_keyset_from_keys, random_alphanum_str, random_alphanum_bytes, to_str, to_bytes, KeyFileReverter, token_claim_1h, write_file_atomic, assert_denied, wait_until, tenant_tr_accepted, tenant_tr_denied, wait_until_tenant_tr_succeeds, wait_until_tenant_tr_fails
 
-special_key_ranges = [
+KeyRange = collections.namedtuple("KeyRange", "name begin end")
+
+SPECIAL_KEY_RANGES = tuple(KeyRange(name, begin, end) for name, begin, end in [
     ("transaction description", b"/description", b"/description\x00"),
     ("global knobs", b"/globalKnobs", b"/globalKnobs\x00"),
     ("knobs", b"/knobs0", b"/knobs0\x00"),
     ("conflicting keys", b"/transaction/conflicting_keys/", b"/transaction/conflicting_keys/\xff\xff"),
     ("read conflict range", b"/transaction/read_conflict_range/", b"/transaction/read_conflict_range/\xff\xff"),
-    ("conflicting keys", b"/transaction/write_conflict_range/", b"/transaction/write_conflict_range/\xff\xff"),
+    ("write conflict range", b"/transaction/write_conflict_range/", b"/transaction/write_conflict_range/\xff\xff"),
     ("data distribution stats", b"/metrics/data_distribution_stats/", b"/metrics/data_distribution_stats/\xff\xff"),
     ("kill storage", b"/globals/killStorage", b"/globals/killStorage\x00"),
-]
+])
 
 def test_simple_tenant_access(private_key, token_gen, default_tenant, tenant_tr_gen):
     token = token_gen(private_key, token_claim_1h(default_tenant))
@@ -56,83 +58,56 @@ def test_cross_tenant_access_disallowed(private_key, default_tenant, token_gen,
     # use default tenant token with second tenant transaction and see it fail
     second_tenant = random_alphanum_bytes(12)
     tenant_gen(second_tenant)
-    token_second = token_gen(private_key, token_claim_1h(second_tenant))
+    now = time.time()
+    token_second = token_gen(private_key, token_claim_1h(second_tenant, now=now))
+    token_default = token_gen(private_key, token_claim_1h(default_tenant, now=now))
     tr_second = tenant_tr_gen(second_tenant)
     tr_second.options.set_authorization_token(token_second)
     tr_second[b"abc"] = b"def"
     tr_second.commit().wait()
-    token_default = token_gen(private_key, token_claim_1h(default_tenant))
     tr_second = tenant_tr_gen(second_tenant)
     tr_second.options.set_authorization_token(token_default)
     # test that read transaction fails
-    try:
-        value = tr_second[b"abc"].value
-        assert False, f"expected permission denied, but read transaction went through, value: {value}"
-    except fdb.FDBError as e:
-        assert e.code == 6000, f"expected permission_denied, got {e} instead"
+    assert_denied(lambda: tr_second[b"abc"].value, "cross-tenant read transaction")
     # test that write transaction fails
     tr_second = tenant_tr_gen(second_tenant)
     tr_second.options.set_authorization_token(token_default)
-    try:
-        tr_second[b"def"] = b"ghi"
-        tr_second.commit().wait()
-        assert False, "expected permission denied, but write transaction went through"
-    except fdb.FDBError as e:
-        assert e.code == 6000, f"expected permission_denied, got {e} instead"
+    tr_second[b"def"] = b"ghi"
+    assert_denied(lambda: tr_second.commit().wait(), "cross-tenant write transaction")
 
-def test_system_and_special_key_range_disallowed(db, tenant_tr_gen, token_gen):
+def test_system_key_range_disallowed(db):
     second_tenant = random_alphanum_bytes(12)
-    try:
-        fdb.tenant_management.create_tenant(db, second_tenant)
-        assert False, "disallowed create_tenant has succeeded"
-    except fdb.FDBError as e:
-        assert e.code == 6000, f"expected permission_denied, got {e} instead"
+    assert_denied(lambda: fdb.tenant_management.create_tenant(db, second_tenant), "create_tenant")
 
-    try:
-        tr = db.create_transaction()
-        tr.options.set_access_system_keys()
-        kvs = tr.get_range(b"\xff", b"\xff\xff", limit=1).to_list()
-        assert False, f"disallowed system keyspace read has succeeded. found item: {kvs}"
-    except fdb.FDBError as e:
-        assert e.code == 6000, f"expected permission_denied, got {e} instead"
+    # a denied read leaves no mutation state behind, so both read probes can share one transaction
+    tr = db.create_transaction()
+    tr.options.set_access_system_keys()
+    assert_denied(lambda: tr.get_range(b"\xff", b"\xff\xff", limit=1).to_list(), "system keyspace read")
+    assert_denied(lambda: tr.get_range(b"", b"\xff", limit=1).to_list(), "normal keyspace read")
+    # reset() clears transaction options as well, so access to system keys needs to be re-enabled
+    tr.reset()
+    tr.options.set_access_system_keys()
+    del tr[b"\xff":b"\xff\xff"]
+    assert_denied(lambda: tr.commit().wait(), "system keyspace write")
 
-    for range_name, special_range_begin, special_range_end in special_key_ranges:
-        tr = db.create_transaction()
-        tr.options.set_access_system_keys()
-        tr.options.set_special_key_space_relaxed()
-        try:
-            kvs = tr.get_range(special_range_begin, special_range_end, limit=1).to_list()
-            assert False, f"disallowed special keyspace read for range {range_name} has succeeded. found item {kvs}"
-        except fdb.FDBError as e:
-            assert e.code == 6000, f"expected permission_denied from attempted read to range {range_name}, got {e} instead"
-
-    try:
-        tr = db.create_transaction()
-        tr.options.set_access_system_keys()
-        del tr[b"\xff":b"\xff\xff"]
-        tr.commit().wait()
-        assert False, f"disallowed system keyspace write has succeeded"
-    except fdb.FDBError as e:
-        assert e.code == 6000, f"expected permission_denied, got {e} instead"
+@pytest.mark.parametrize("rng", SPECIAL_KEY_RANGES, ids=[rng.name for rng in SPECIAL_KEY_RANGES])
+def test_special_key_range_read_disallowed(db, rng):
+    tr = db.create_transaction()
+    tr.options.set_access_system_keys()
+    tr.options.set_special_key_space_relaxed()
+    assert_denied(lambda: tr.get_range(rng.begin, rng.end, limit=1).to_list(), f"attempted read to range {rng.name}")
 
-    for range_name, special_range_begin, special_range_end in special_key_ranges:
+def test_special_key_range_write_disallowed(db):
+    # submit all commits first and only then wait, so that the denials are served concurrently
+    pending = []
+    for rng in SPECIAL_KEY_RANGES:
         tr = db.create_transaction()
         tr.options.set_access_system_keys()
         tr.options.set_special_key_space_relaxed()
-        try:
-            del tr[special_range_begin:special_range_end]
-            tr.commit().wait()
-            assert False, f"write to disallowed special keyspace range {range_name} has succeeded"
-        except fdb.FDBError as e:
-            assert e.code == 6000, f"expected permission_denied from attempted write to range {range_name}, got {e} instead"
-
-    try:
-        tr = db.create_transaction()
-        tr.options.set_access_system_keys()
-        kvs = tr.get_range(b"", b"\xff", limit=1).to_list()
-        assert False, f"disallowed normal keyspace read has succeeded. found item {kvs}"
-    except fdb.FDBError as e:
-        assert e.code == 6000, f"expected permission_denied, got {e} instead"
+        del tr[rng.begin:rng.end]
+        pending.append((rng, tr, tr.commit()))
+    for rng, tr, future in pending:
+        assert_denied(future.wait, f"attempted write to range {rng.name}")
 
 def test_public_key_set_rollover(
         kty, private_key_gen, private_key, public_key_refresh_interval,
@@ -155,17 +130,20 @@ def test_public_key_set_rollover(
         old_key_json = keyfile.read()
 
     delay = public_key_refresh_interval
+    # instead of sleeping for a fixed multiple of the refresh interval, probe with cheap transactions until the keyset change is observed
+    timeout = max_repeat * delay
 
-    with KeyFileReverter(cluster.public_key_json_file, old_key_json, delay):
-        with open(cluster.public_key_json_file, "w") as keyfile:
-            keyfile.write(interim_set)
-        wait_until_tenant_tr_succeeds(second_tenant, new_key, tenant_tr_gen, token_gen, max_repeat, delay)
+    with KeyFileReverter(
+            cluster.public_key_json_file, old_key_json, delay,
+            ready=lambda: tenant_tr_accepted(default_tenant, token_gen(private_key, token_claim_1h(default_tenant)), tenant_tr_gen),
+            timeout=timeout):
+        write_file_atomic(cluster.public_key_json_file, interim_set)
+        wait_until(lambda: tenant_tr_accepted(second_tenant, token_second, tenant_tr_gen), timeout)
         print("interim key set activated")
         final_set = public_keyset_from_keys([new_key])
         print(f"final keyset: {final_set}")
-        with open(cluster.public_key_json_file, "w") as keyfile:
-            keyfile.write(final_set)
-        wait_until_tenant_tr_fails(default_tenant, private_key, tenant_tr_gen, token_gen, max_repeat, delay)
+        write_file_atomic(cluster.public_key_json_file, final_set)
+        wait_until(lambda: tenant_tr_denied(default_tenant, private_key, tenant_tr_gen, token_gen), timeout)
 
 def test_public_key_set_broken_file_tolerance(
         private_key, public_key_refresh_interval,
@@ -232,66 +210,51 @@ def test_public_key_set_empty_file_tolerance(
         wait_until_tenant_tr_succeeds(default_tenant, private_key, tenant_tr_gen, token_gen, max_repeat, delay)
 
 def test_bad_token(private_key, token_gen, default_tenant, tenant_tr_gen):
-    def del_attr(d, attr):
-        del d[attr]
-        return d
-
-    def set_attr(d, attr, value):
-        d[attr] = value
-        return d
-
+    base_now = time.time()
+    # (case name, claim attribute to drop or override, override value or None to drop the attribute)
     claim_mutations = [
-        ("no nbf", lambda claim: del_attr(claim, "nbf")),
-        ("no exp", lambda claim: del_attr(claim, "exp")),
-        ("no iat", lambda claim: del_attr(claim, "iat")),
-        ("too early", lambda claim: set_attr(claim, "nbf", time.time() + 30)),
-        ("too late", lambda claim: set_attr(claim, "exp", time.time() - 10)),
-        ("no tenants", lambda claim: del_attr(claim, "tenants")),
-        ("empty tenants", lambda claim: set_attr(claim, "tenants", [])),
+        ("no nbf", "nbf", None),
+        ("no exp", "exp", None),
+        ("no iat", "iat", None),
+        ("too early", "nbf", base_now + 30),
+        ("too late", "exp", base_now - 10),
+        ("no tenants", "tenants", None),
+        ("empty tenants", "tenants", []),
     ]
-    for case_name, mutation in claim_mutations:
+    # issue every read and commit first, then resolve them, so that the expected denials are served concurrently
+    pending = []
+    for case_name, attr, value in claim_mutations:
+        claim = token_claim_1h(default_tenant, now=base_now)
+        if value is None:
+            del claim[attr]
+        else:
+            claim[attr] = value
+        token = token_gen(private_key, claim)
         tr = tenant_tr_gen(default_tenant)
-        tr.options.set_authorization_token(token_gen(private_key, mutation(token_claim_1h(default_tenant))))
-        try:
-            value = tr[b"abc"].value
-            assert False, f"expected permission_denied for case {case_name}, but read transaction went through"
-        except fdb.FDBError as e:
-            assert e.code == 6000, f"expected permission_denied for case {case_name}, got {e} instead"
+        tr.options.set_authorization_token(token)
+        pending.append((case_name, "read", tr, tr[b"abc"]))
         tr = tenant_tr_gen(default_tenant)
-        tr.options.set_authorization_token(token_gen(private_key, mutation(token_claim_1h(default_tenant))))
+        tr.options.set_authorization_token(token)
         tr[b"abc"] = b"def"
-        try:
-            tr.commit().wait()
-            assert False, f"expected permission_denied for case {case_name}, but write transaction went through"
-        except fdb.FDBError as e:
-            assert e.code == 6000, f"expected permission_denied for case {case_name}, got {e} instead"
+        pending.append((case_name, "write", tr, tr.commit()))
+    for case_name, kind, tr, future in pending:
+        assert_denied(future.wait, f"{kind} transaction for case {case_name}")
 
     # unknown key case: override "kid" field in header
-    # first, update only the kid field of key with export-update-import
-    key_dict = private_key.as_dict(is_private=True)
-    key_dict["kid"] = random_alphanum_str(10)
-    renamed_key = authlib.jose.JsonWebKey.import_key(key_dict)
+    # the server looks the signing key up by the header's kid, so the original key can sign as-is
     unknown_key_token = token_gen(
-                renamed_key,
+                private_key,
                 token_claim_1h(default_tenant),
                 headers={
                     "typ": "JWT",
-                    "kty": renamed_key.kty,
-                    "alg": alg_from_kty(renamed_key.kty),
-                    "kid": renamed_key.kid,
+                    "kty": private_key.kty,
+                    "alg": alg_from_kty(private_key.kty),
+                    "kid": random_alphanum_str(10),
                 })
     tr = tenant_tr_gen(default_tenant)
     tr.options.set_authorization_token(unknown_key_token)
-    try:
-        value = tr[b"abc"].value
-        assert False, f"expected permission_denied for 'unknown key' case, but read transaction went through"
-    except fdb.FDBError as e:
-        assert e.code == 6000, f"expected permission_denied for 'unknown key' case, got {e} instead"
+    assert_denied(lambda: tr[b"abc"].value, "read transaction for 'unknown key' case")
     tr = tenant_tr_gen(default_tenant)
     tr.options.set_authorization_token(unknown_key_token)
     tr[b"abc"] = b"def"
-    try:
-        tr.commit().wait()
-        assert False, f"expected permission_denied for 'unknown key' case, but write transaction went through"
-    except fdb.FDBError as e:
-        assert e.code == 6000, f"expected permission_denied for 'unknown key' case, got {e} instead"
+    assert_denied(lambda: tr.commit().wait(), "write transaction for 'unknown key' case")
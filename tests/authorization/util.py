@@ -1,5 +1,6 @@
 import fdb
 import json
+import os
 import random
 import string
 import time
@@ -42,24 +43,50 @@ def public_keyset_from_keys(keys: List):
     keys = list(map(lambda key: key.as_dict(is_private=False, alg=alg_from_kty(key.kty)), keys))
     return json.dumps({ "keys": keys })
 
+# replace the file's content atomically, so that a concurrent reader never sees a partially written file
+def write_file_atomic(filename: str, content: str):
+    try:
+        old_mtime = int(os.stat(filename).st_mtime)
+    except FileNotFoundError:
+        old_mtime = None
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+    # the server only notices a key file change when its mtime changes, and compares mtimes at one-second resolution.
+    # writes in quick succession may land within the same second, so move the mtime forward past the previous one
+    if old_mtime is not None and int(os.stat(filename).st_mtime) <= old_mtime:
+        os.utime(filename, (old_mtime + 1, old_mtime + 1))
+
 class KeyFileReverter(object):
-    def __init__(self, filename: str, content: str, refresh_delay: int):
+    def __init__(self, filename: str, content: str, refresh_delay: int, ready=None, timeout=None):
         self.filename = filename
         self.content = content
         self.refresh_delay = refresh_delay
+        # if given, ready() is polled after reverting instead of sleeping for a fixed duration.
+        # it is skipped if the with-block raised, so that a timeout here cannot mask the original failure
+        self.ready = ready
+        self.timeout = timeout if timeout is not None else refresh_delay * 10
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        with open(self.filename, "w") as keyfile:
-            keyfile.write(self.content)
-        print(f"key file reverted. waiting {self.refresh_delay * 2} seconds for the update to take effect...")
-        time.sleep(self.refresh_delay * 2)
-
-# JWT claim that is valid for 1 hour since time of invocation
-def token_claim_1h(tenant_name):
-    now = time.time()
+        write_file_atomic(self.filename, self.content)
+        if self.ready is not None and exc_type is None:
+            print(f"key file reverted. waiting up to {self.timeout} seconds for the update to take effect...")
+            wait_until(self.ready, self.timeout)
+        else:
+            print(f"key file reverted. waiting {self.refresh_delay * 2} seconds for the update to take effect...")
+            time.sleep(self.refresh_delay * 2)
+
+# JWT claim that is valid for 1 hour since time of invocation, or since now if given
+# sibling claims built within a test may share now
+def token_claim_1h(tenant_name, now=None):
+    if now is None:
+        now = time.time()
     return {
         "iss": "fdb-authz-tester",
         "sub": "authz-test",
@@ -71,6 +98,62 @@ def token_claim_1h(tenant_name):
         "tenants": [to_str(tenant_name)],
     }
 
+# call fn and assert that it fails with permission_denied. what describes the attempted operation in failure messages
+def assert_denied(fn, what: str):
+    try:
+        result = fn()
+    except fdb.FDBError as e:
+        if e.code != 6000:
+            raise AssertionError(f"expected permission_denied from {what}, got {e} instead")
+        return
+    raise AssertionError(f"expected permission_denied from {what}, but it went through. result: {result}")
+
+# poll pred every interval seconds until it returns True, raising TimeoutError if that takes longer than timeout seconds
+def wait_until(pred, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if pred():
+            return
+        time.sleep(interval)
+    raise TimeoutError(f"condition was not met in {timeout} seconds")
+
+# single probe: whether both read and write tr for tenant go through with the given token
+# important: only use this function if you don't have any data dependencies to key "abc"
+def tenant_tr_accepted(tenant, token, tenant_tr_gen):
+    tr = tenant_tr_gen(tenant)
+    tr.options.set_authorization_token(token)
+    try:
+        value = tr[b"abc"].value
+        tr[b"abc"] = b"qwe"
+        tr.commit().wait()
+        return True
+    except fdb.FDBError as e:
+        assert e.code == 6000, f"expected permission_denied, got {e} instead"
+        return False
+
+# single probe: whether both read and write tr for tenant fail with permission_denied
+# important: only use this function if you don't have any data dependencies to key "abc"
+def tenant_tr_denied(tenant, private_key, tenant_tr_gen, token_gen):
+    # a token needs to be generated at every probe because once it is accepted/cached,
+    # it will pass verification by caching until it expires
+    token = token_gen(private_key, token_claim_1h(tenant))
+    tr = tenant_tr_gen(tenant)
+    tr.options.set_authorization_token(token)
+    try:
+        value = tr[b"abc"].value
+        return False
+    except fdb.FDBError as e:
+        assert e.code == 6000, f"expected permission_denied, got {e} instead"
+    tr = tenant_tr_gen(tenant)
+    tr.options.set_authorization_token(token)
+    try:
+        tr[b"abc"] = b"def"
+        tr.commit().wait()
+        return False
+    except fdb.FDBError as e:
+        assert e.code == 6000, f"expected permission_denied, got {e} instead"
+    return True
+
 # repeat try-wait loop up to max_repeat times until both read and write tr fails for tenant with permission_denied
 # important: only use this function if you don't have any data dependencies to key "abc"
 def wait_until_tenant_tr_fails(tenant, private_key, tenant_tr_gen, token_gen, max_repeat, delay):
@@ -110,15 +193,8 @@ def wait_until_tenant_tr_succeeds(tenant, private_key, tenant_tr_gen, token_gen,
     repeat = 0
     token = token_gen(private_key, token_claim_1h(tenant))
     while repeat < max_repeat:
-        try:
-            time.sleep(delay)
-            tr = tenant_tr_gen(tenant)
-            tr.options.set_authorization_token(token)
-            value = tr[b"abc"].value
-            tr[b"abc"] = b"qwe"
-            tr.commit().wait()
+        time.sleep(delay)
+        if tenant_tr_accepted(tenant, token, tenant_tr_gen):
             break
-        except fdb.FDBError as e:
-            assert e.code == 6000, f"expected permission_denied, got {e} instead"
-            repeat += 1
+        repeat += 1
     assert repeat < max_repeat, f"tenant transaction did not start to succeed in {max_repeat * delay} seconds"